@@ -9,13 +9,14 @@ import logging
 
 p = argparse.ArgumentParser(prog=PROG_NAME, description="Analyzes and edits PNG Chunks")
 p.add_argument("-i", "--ignore-errors", action="store_true", help="Ignore Length, Name and CRC errors")
+p.add_argument("-s", "--skip-crc", action="store_true", help="Don't verify the chunk CRCs")
 p.add_argument("-v", "--verbose", action="store_const", default=logging.INFO, const=logging.DEBUG, help="be more verbose")
 p.add_argument("file", metavar="FILE", type=argparse.FileType("rb"), help="Input file")
 args = p.parse_args()
 
 logging.basicConfig(format="[%(asctime)s] %(levelname)s: %(message)s", level=args.verbose)
 
-png = PNG.load(args.file.read(), ignore_errors=args.ignore_errors)
+png = PNG.load(args.file.read(), ignore_errors=args.ignore_errors, verify=not args.skip_crc)
 
 print(png)
 for chunk in png.chunks:
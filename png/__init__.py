@@ -1,11 +1,13 @@
 PNG_HEADER = b"\x89PNG\r\n\x1a\n"
 
-import struct
 import logging
 L = logging.getLogger("PNG.png")
 
 from . import chunks, filter
 
+# zlib only releases the GIL for more data than this, smaller chunks are
+# verified inline instead of paying for a round trip through the executor
+PARALLEL_CRC_MIN_LENGTH = 5*1024
 
 
 chunk_map = {
@@ -25,7 +27,16 @@ class PNG(object):
 		self.chunks = []
 
 	@staticmethod
-	def load(data, ignore_errors=False):
+	def load(data, ignore_errors=False, verify=True, executor=None):
+		"""Load a PNG file
+
+		With verify=False the chunk CRCs are not checked, which saves
+		going over all of the data when only the chunk headers matter.
+		If a concurrent.futures executor is given the CRCs of chunks
+		larger than PARALLEL_CRC_MIN_LENGTH are verified on it. zlib
+		releases the GIL while calculating the CRC of big chunks, so a
+		ThreadPoolExecutor helps with large IDAT chunks.
+		"""
 		inst = PNG(ignore_errors=ignore_errors)
 		inst.data = data
 		inst.length = len(data)
@@ -34,23 +45,30 @@ class PNG(object):
 			L.error(msg)
 			if not ignore_errors: raise ValueError(msg)
 
+		# slices of the view don't copy the chunk data
+		view = memoryview(data)
+		crc_checks = []
 		chunk_start = 8
 		while chunk_start < inst.length:
-			(chunk_length, chunk_name) = struct.unpack("!I4s", data[chunk_start:chunk_start+8])
+			(chunk_length, chunk_name) = chunks.HEADER.unpack_from(data, chunk_start)
 			chunk_end = chunk_start + chunk_length + 12
 			L.debug("Processing {} chunk data {}-{}".format(chunk_name, chunk_start, chunk_end))
-			chunk = chunk_map.get(chunk_name, chunks.Chunk).load(data[chunk_start:chunk_end])
+			parallel = verify and executor is not None and chunk_length > PARALLEL_CRC_MIN_LENGTH
+			chunk = chunk_map.get(chunk_name, chunks.Chunk).load(view[chunk_start:chunk_end], verify=verify and not parallel)
+			if parallel:
+				crc_checks.append(executor.submit(chunk.verify_crc))
 			L.debug("New chunk: {}".format(chunk))
 			inst.chunks.append(chunk)
 			chunk_start = chunk_end
 
+		for crc_check in crc_checks:
+			crc_check.result() # raises CRC errors
 		return inst
 
 	def dump(self):
-		data = PNG_HEADER
-		for chunk in self.chunks:
-			data += chunk.dump()
-		return data
+		parts = [PNG_HEADER]
+		parts.extend(chunk.dump() for chunk in self.chunks)
+		return b"".join(parts)
 
 	def __str__(self):
 		return "<PNG length={length} chunks={}>".format(len(self.chunks), **self.__dict__)
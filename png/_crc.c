@@ -0,0 +1,210 @@
+/*
+ * CRC-32 as used by PNG (and zlib)
+ *
+ * crc32(data, value=0) is a drop-in for zlib.crc32. On x86 CPUs with
+ * PCLMULQDQ the bulk of the data is folded with carry-less multiplies,
+ * following Intel's "Fast CRC Computation for Generic Polynomials Using
+ * PCLMULQDQ Instruction" paper; the rest goes through a lookup table.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#include <stdint.h>
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#define PNG_CRC_PCLMUL
+#include <emmintrin.h>
+#include <wmmintrin.h>
+#endif
+
+/* reflected polynomial 0x04C11DB7 */
+#define CRC_POLY 0xEDB88320u
+
+static uint32_t crc_table[256];
+
+static void
+make_crc_table(void)
+{
+	uint32_t n, k, c;
+	for (n = 0; n < 256; n++) {
+		c = n;
+		for (k = 0; k < 8; k++)
+			c = c & 1 ? CRC_POLY ^ (c >> 1) : c >> 1;
+		crc_table[n] = c;
+	}
+}
+
+/* crc is the inverted running value */
+static uint32_t
+crc32_table(uint32_t crc, const uint8_t *buf, Py_ssize_t len)
+{
+	while (len--)
+		crc = crc_table[(crc ^ *buf++) & 0xff] ^ (crc >> 8);
+	return crc;
+}
+
+#ifdef PNG_CRC_PCLMUL
+
+/* the folding needs at least one 64 byte block */
+#define PCLMUL_MIN_LENGTH 64
+
+static int have_pclmul;
+
+/* crc is the inverted running value, len >= 64 and a multiple of 16 */
+__attribute__((target("sse2,pclmul")))
+static uint32_t
+crc32_pclmul(uint32_t crc, const uint8_t *buf, Py_ssize_t len)
+{
+	/* fold constants x^(4*128+32), x^(4*128-32), x^(128+32), x^(128-32),
+	 * x^64 mod P and the Barrett constants P and mu, all bit reflected */
+	const __m128i k1k2 = _mm_set_epi64x(0x01c6e41596, 0x0154442bd4);
+	const __m128i k3k4 = _mm_set_epi64x(0x00ccaa009e, 0x01751997d0);
+	const __m128i k5k0 = _mm_set_epi64x(0, 0x0163cd6124);
+	const __m128i poly = _mm_set_epi64x(0x01f7011641, 0x01db710641);
+	const __m128i mask32 = _mm_setr_epi32(~0, 0, ~0, 0);
+	__m128i x0, x1, x2, x3, x4, x5, x6, x7, x8;
+
+	x1 = _mm_loadu_si128((const __m128i *)(buf + 0x00));
+	x2 = _mm_loadu_si128((const __m128i *)(buf + 0x10));
+	x3 = _mm_loadu_si128((const __m128i *)(buf + 0x20));
+	x4 = _mm_loadu_si128((const __m128i *)(buf + 0x30));
+	x1 = _mm_xor_si128(x1, _mm_cvtsi32_si128((int)crc));
+	buf += 64;
+	len -= 64;
+
+	/* fold 4x128 bits in parallel */
+	x0 = k1k2;
+	while (len >= 64) {
+		x5 = _mm_clmulepi64_si128(x1, x0, 0x00);
+		x6 = _mm_clmulepi64_si128(x2, x0, 0x00);
+		x7 = _mm_clmulepi64_si128(x3, x0, 0x00);
+		x8 = _mm_clmulepi64_si128(x4, x0, 0x00);
+		x1 = _mm_clmulepi64_si128(x1, x0, 0x11);
+		x2 = _mm_clmulepi64_si128(x2, x0, 0x11);
+		x3 = _mm_clmulepi64_si128(x3, x0, 0x11);
+		x4 = _mm_clmulepi64_si128(x4, x0, 0x11);
+		x1 = _mm_xor_si128(_mm_xor_si128(x1, x5), _mm_loadu_si128((const __m128i *)(buf + 0x00)));
+		x2 = _mm_xor_si128(_mm_xor_si128(x2, x6), _mm_loadu_si128((const __m128i *)(buf + 0x10)));
+		x3 = _mm_xor_si128(_mm_xor_si128(x3, x7), _mm_loadu_si128((const __m128i *)(buf + 0x20)));
+		x4 = _mm_xor_si128(_mm_xor_si128(x4, x8), _mm_loadu_si128((const __m128i *)(buf + 0x30)));
+		buf += 64;
+		len -= 64;
+	}
+
+	/* fold the four lanes into one */
+	x0 = k3k4;
+	x5 = _mm_clmulepi64_si128(x1, x0, 0x00);
+	x1 = _mm_clmulepi64_si128(x1, x0, 0x11);
+	x1 = _mm_xor_si128(_mm_xor_si128(x1, x2), x5);
+	x5 = _mm_clmulepi64_si128(x1, x0, 0x00);
+	x1 = _mm_clmulepi64_si128(x1, x0, 0x11);
+	x1 = _mm_xor_si128(_mm_xor_si128(x1, x3), x5);
+	x5 = _mm_clmulepi64_si128(x1, x0, 0x00);
+	x1 = _mm_clmulepi64_si128(x1, x0, 0x11);
+	x1 = _mm_xor_si128(_mm_xor_si128(x1, x4), x5);
+
+	/* fold the remaining 16 byte blocks */
+	while (len >= 16) {
+		x5 = _mm_clmulepi64_si128(x1, x0, 0x00);
+		x1 = _mm_clmulepi64_si128(x1, x0, 0x11);
+		x1 = _mm_xor_si128(_mm_xor_si128(x1, _mm_loadu_si128((const __m128i *)buf)), x5);
+		buf += 16;
+		len -= 16;
+	}
+
+	/* fold 128 to 64 bits */
+	x2 = _mm_clmulepi64_si128(x1, x0, 0x10);
+	x1 = _mm_xor_si128(_mm_srli_si128(x1, 8), x2);
+	x2 = _mm_srli_si128(x1, 4);
+	x1 = _mm_and_si128(x1, mask32);
+	x1 = _mm_clmulepi64_si128(x1, k5k0, 0x00);
+	x1 = _mm_xor_si128(x1, x2);
+
+	/* Barrett reduction to 32 bits */
+	x2 = _mm_and_si128(x1, mask32);
+	x2 = _mm_clmulepi64_si128(x2, poly, 0x10);
+	x2 = _mm_and_si128(x2, mask32);
+	x2 = _mm_clmulepi64_si128(x2, poly, 0x00);
+	x1 = _mm_xor_si128(x1, x2);
+
+	return (uint32_t)_mm_cvtsi128_si32(_mm_srli_si128(x1, 4));
+}
+
+#endif
+
+static uint32_t
+crc32_update(uint32_t crc, const uint8_t *buf, Py_ssize_t len)
+{
+	crc = ~crc;
+#ifdef PNG_CRC_PCLMUL
+	if (have_pclmul && len >= PCLMUL_MIN_LENGTH) {
+		Py_ssize_t bulk = len & ~(Py_ssize_t)15;
+		crc = crc32_pclmul(crc, buf, bulk);
+		buf += bulk;
+		len -= bulk;
+	}
+#endif
+	return ~crc32_table(crc, buf, len);
+}
+
+/* like zlib, only release the GIL when it is worth it */
+#define GIL_MINSIZE 5120
+
+static PyObject *
+crc32(PyObject *self, PyObject *args)
+{
+	Py_buffer data;
+	unsigned int value = 0;
+	uint32_t crc;
+
+	if (!PyArg_ParseTuple(args, "y*|I:crc32", &data, &value))
+		return NULL;
+
+	if (data.len > GIL_MINSIZE) {
+		Py_BEGIN_ALLOW_THREADS
+		crc = crc32_update(value, data.buf, data.len);
+		Py_END_ALLOW_THREADS
+	} else {
+		crc = crc32_update(value, data.buf, data.len);
+	}
+	PyBuffer_Release(&data);
+	return PyLong_FromUnsignedLong(crc);
+}
+
+static PyMethodDef crc_methods[] = {
+	{"crc32", crc32, METH_VARARGS,
+	 "crc32(data, value=0) -> int\n\n"
+	 "Compute a CRC-32 of data starting with value, like zlib.crc32."},
+	{NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef crc_module = {
+	PyModuleDef_HEAD_INIT,
+	"png._crc",
+	"CRC-32 using PCLMULQDQ where available",
+	-1,
+	crc_methods
+};
+
+PyMODINIT_FUNC
+PyInit__crc(void)
+{
+	PyObject *module = PyModule_Create(&crc_module);
+	if (module == NULL)
+		return NULL;
+	make_crc_table();
+#ifdef PNG_CRC_PCLMUL
+	__builtin_cpu_init();
+	have_pclmul = __builtin_cpu_supports("pclmul") && __builtin_cpu_supports("sse2");
+	if (PyModule_AddIntConstant(module, "pclmul", have_pclmul) < 0) {
+		Py_DECREF(module);
+		return NULL;
+	}
+#else
+	if (PyModule_AddIntConstant(module, "pclmul", 0) < 0) {
+		Py_DECREF(module);
+		return NULL;
+	}
+#endif
+	return module;
+}
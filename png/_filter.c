@@ -0,0 +1,414 @@
+/*
+ * PNG filter reconstruction
+ *
+ * reconstruct(data, width, bpp, prev_line=None) takes the decompressed
+ * IDAT stream (filter type byte followed by the filtered scanline, for
+ * every line) and returns the raw pixel data. prev_line is the
+ * reconstructed scanline before data when decoding in parts. It matches
+ * png.filter.decode.
+ *
+ * Up uses the full vector width. Sub, Average and Paeth depend on the
+ * reconstructed left neighbour, so like libpng those are vectorized over
+ * the bytes of one pixel for pixels of 3 bytes and more.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+#if defined(__SSE2__) || defined(_M_X64) || (defined(_M_IX86_FP) && _M_IX86_FP >= 2)
+#define PNG_FILTER_SSE2
+#include <emmintrin.h>
+#elif defined(__ARM_NEON) || defined(__ARM_NEON__)
+#define PNG_FILTER_NEON
+#include <arm_neon.h>
+#endif
+
+enum {
+	FILTER_NONE = 0,
+	FILTER_SUB = 1,
+	FILTER_UP = 2,
+	FILTER_AVERAGE = 3,
+	FILTER_PAETH = 4,
+};
+
+/* scalar versions, reconstruct line in place */
+
+static void
+sub_scalar(uint8_t *line, Py_ssize_t length, Py_ssize_t bpp)
+{
+	Py_ssize_t i;
+	for (i = bpp; i < length; i++)
+		line[i] += line[i - bpp];
+}
+
+static void
+up_scalar(uint8_t *line, const uint8_t *prev, Py_ssize_t start, Py_ssize_t length)
+{
+	Py_ssize_t i;
+	for (i = start; i < length; i++)
+		line[i] += prev[i];
+}
+
+static void
+average_scalar(uint8_t *line, const uint8_t *prev, Py_ssize_t length, Py_ssize_t bpp)
+{
+	Py_ssize_t i;
+	for (i = 0; i < bpp && i < length; i++)
+		line[i] += prev[i] >> 1;
+	for (i = bpp; i < length; i++)
+		line[i] += (line[i - bpp] + prev[i]) >> 1;
+}
+
+static uint8_t
+paeth_predictor(int a, int b, int c)
+{
+	int pa = abs(b - c);
+	int pb = abs(a - c);
+	int pc = abs(a + b - c - c);
+	if (pa <= pb && pa <= pc)
+		return (uint8_t)a;
+	if (pb <= pc)
+		return (uint8_t)b;
+	return (uint8_t)c;
+}
+
+static void
+paeth_scalar(uint8_t *line, const uint8_t *prev, Py_ssize_t length, Py_ssize_t bpp)
+{
+	Py_ssize_t i;
+	for (i = 0; i < bpp && i < length; i++)
+		line[i] += prev[i];
+	for (i = bpp; i < length; i++)
+		line[i] += paeth_predictor(line[i - bpp], prev[i], prev[i - bpp]);
+}
+
+#if defined(PNG_FILTER_SSE2)
+
+/* pixels are up to 8 bytes (16 bit RGBA), go through a padded buffer */
+
+static __m128i
+load_pixel(const uint8_t *p, Py_ssize_t bpp)
+{
+	uint8_t buf[8] = {0};
+	memcpy(buf, p, bpp);
+	return _mm_loadl_epi64((const __m128i *)buf);
+}
+
+static void
+store_pixel(uint8_t *p, __m128i v, Py_ssize_t bpp)
+{
+	uint8_t buf[8];
+	_mm_storel_epi64((__m128i *)buf, v);
+	memcpy(p, buf, bpp);
+}
+
+static __m128i
+abs_epi16(__m128i x)
+{
+	return _mm_max_epi16(x, _mm_sub_epi16(_mm_setzero_si128(), x));
+}
+
+static __m128i
+select_si128(__m128i mask, __m128i a, __m128i b)
+{
+	return _mm_or_si128(_mm_and_si128(mask, a), _mm_andnot_si128(mask, b));
+}
+
+static void
+up_simd(uint8_t *line, const uint8_t *prev, Py_ssize_t length)
+{
+	Py_ssize_t i;
+	for (i = 0; i + 16 <= length; i += 16) {
+		__m128i l = _mm_loadu_si128((const __m128i *)(line + i));
+		__m128i p = _mm_loadu_si128((const __m128i *)(prev + i));
+		_mm_storeu_si128((__m128i *)(line + i), _mm_add_epi8(l, p));
+	}
+	up_scalar(line, prev, i, length);
+}
+
+static void
+sub_simd(uint8_t *line, Py_ssize_t length, Py_ssize_t bpp)
+{
+	__m128i a = _mm_setzero_si128();
+	Py_ssize_t i;
+	for (i = 0; i < length; i += bpp) {
+		a = _mm_add_epi8(load_pixel(line + i, bpp), a);
+		store_pixel(line + i, a, bpp);
+	}
+}
+
+static void
+average_simd(uint8_t *line, const uint8_t *prev, Py_ssize_t length, Py_ssize_t bpp)
+{
+	const __m128i ones = _mm_set1_epi8(1);
+	__m128i a = _mm_setzero_si128();
+	Py_ssize_t i;
+	for (i = 0; i < length; i += bpp) {
+		__m128i b = load_pixel(prev + i, bpp);
+		/* _mm_avg_epu8 rounds up, the filter rounds down */
+		__m128i avg = _mm_sub_epi8(_mm_avg_epu8(a, b),
+			_mm_and_si128(_mm_xor_si128(a, b), ones));
+		a = _mm_add_epi8(load_pixel(line + i, bpp), avg);
+		store_pixel(line + i, a, bpp);
+	}
+}
+
+static void
+paeth_simd(uint8_t *line, const uint8_t *prev, Py_ssize_t length, Py_ssize_t bpp)
+{
+	const __m128i zero = _mm_setzero_si128();
+	__m128i a = zero, c = zero, d = zero;
+	Py_ssize_t i;
+	for (i = 0; i < length; i += bpp) {
+		__m128i b = _mm_unpacklo_epi8(load_pixel(prev + i, bpp), zero);
+		__m128i pa, pb, pc, smallest, nearest;
+		a = d;
+		d = _mm_unpacklo_epi8(load_pixel(line + i, bpp), zero);
+
+		/* p = a+b-c, so pa = |b-c|, pb = |a-c| and pc = |(b-c) + (a-c)| */
+		pa = _mm_sub_epi16(b, c);
+		pb = _mm_sub_epi16(a, c);
+		pc = _mm_add_epi16(pa, pb);
+		pa = abs_epi16(pa);
+		pb = abs_epi16(pb);
+		pc = abs_epi16(pc);
+		smallest = _mm_min_epi16(pc, _mm_min_epi16(pa, pb));
+		nearest = select_si128(_mm_cmpeq_epi16(smallest, pa), a,
+			select_si128(_mm_cmpeq_epi16(smallest, pb), b, c));
+
+		/* byte-wise add keeps every 16 bit lane within 0-255 */
+		d = _mm_add_epi8(d, nearest);
+		store_pixel(line + i, _mm_packus_epi16(d, d), bpp);
+		c = b;
+	}
+}
+
+#elif defined(PNG_FILTER_NEON)
+
+static uint8x8_t
+load_pixel(const uint8_t *p, Py_ssize_t bpp)
+{
+	uint8_t buf[8] = {0};
+	memcpy(buf, p, bpp);
+	return vld1_u8(buf);
+}
+
+static void
+store_pixel(uint8_t *p, uint8x8_t v, Py_ssize_t bpp)
+{
+	uint8_t buf[8];
+	vst1_u8(buf, v);
+	memcpy(p, buf, bpp);
+}
+
+static void
+up_simd(uint8_t *line, const uint8_t *prev, Py_ssize_t length)
+{
+	Py_ssize_t i;
+	for (i = 0; i + 16 <= length; i += 16)
+		vst1q_u8(line + i, vaddq_u8(vld1q_u8(line + i), vld1q_u8(prev + i)));
+	up_scalar(line, prev, i, length);
+}
+
+static void
+sub_simd(uint8_t *line, Py_ssize_t length, Py_ssize_t bpp)
+{
+	uint8x8_t a = vdup_n_u8(0);
+	Py_ssize_t i;
+	for (i = 0; i < length; i += bpp) {
+		a = vadd_u8(load_pixel(line + i, bpp), a);
+		store_pixel(line + i, a, bpp);
+	}
+}
+
+static void
+average_simd(uint8_t *line, const uint8_t *prev, Py_ssize_t length, Py_ssize_t bpp)
+{
+	uint8x8_t a = vdup_n_u8(0);
+	Py_ssize_t i;
+	for (i = 0; i < length; i += bpp) {
+		/* vhadd rounds down like the filter */
+		a = vadd_u8(load_pixel(line + i, bpp), vhadd_u8(a, load_pixel(prev + i, bpp)));
+		store_pixel(line + i, a, bpp);
+	}
+}
+
+static void
+paeth_simd(uint8_t *line, const uint8_t *prev, Py_ssize_t length, Py_ssize_t bpp)
+{
+	uint8x8_t a = vdup_n_u8(0), c = vdup_n_u8(0);
+	Py_ssize_t i;
+	for (i = 0; i < length; i += bpp) {
+		uint8x8_t b = load_pixel(prev + i, bpp);
+		uint16x8_t pa = vabdl_u8(b, c);
+		uint16x8_t pb = vabdl_u8(a, c);
+		uint16x8_t pc = vabdq_u16(vaddl_u8(a, b), vaddl_u8(c, c));
+		uint8x8_t pick_a = vmovn_u16(vandq_u16(vcleq_u16(pa, pb), vcleq_u16(pa, pc)));
+		uint8x8_t pick_b = vmovn_u16(vcleq_u16(pb, pc));
+		uint8x8_t nearest = vbsl_u8(pick_a, a, vbsl_u8(pick_b, b, c));
+		a = vadd_u8(load_pixel(line + i, bpp), nearest);
+		store_pixel(line + i, a, bpp);
+		c = b;
+	}
+}
+
+#endif
+
+/* returns -1 for an unknown filter type */
+static int
+reconstruct_line(int filter_type, uint8_t *line, const uint8_t *prev,
+                 Py_ssize_t length, Py_ssize_t bpp)
+{
+#if defined(PNG_FILTER_SSE2) || defined(PNG_FILTER_NEON)
+	/* per pixel vectors only pay off for 3 bytes and more, the
+	 * pixel loops rely on length being a multiple of bpp */
+	int simd_pixels = bpp >= 3 && bpp <= 8 && length % bpp == 0;
+#endif
+	switch (filter_type) {
+	case FILTER_NONE:
+		break;
+	case FILTER_SUB:
+#if defined(PNG_FILTER_SSE2) || defined(PNG_FILTER_NEON)
+		if (simd_pixels) {
+			sub_simd(line, length, bpp);
+			break;
+		}
+#endif
+		sub_scalar(line, length, bpp);
+		break;
+	case FILTER_UP:
+#if defined(PNG_FILTER_SSE2) || defined(PNG_FILTER_NEON)
+		up_simd(line, prev, length);
+#else
+		up_scalar(line, prev, 0, length);
+#endif
+		break;
+	case FILTER_AVERAGE:
+#if defined(PNG_FILTER_SSE2) || defined(PNG_FILTER_NEON)
+		if (simd_pixels) {
+			average_simd(line, prev, length, bpp);
+			break;
+		}
+#endif
+		average_scalar(line, prev, length, bpp);
+		break;
+	case FILTER_PAETH:
+#if defined(PNG_FILTER_SSE2) || defined(PNG_FILTER_NEON)
+		if (simd_pixels) {
+			paeth_simd(line, prev, length, bpp);
+			break;
+		}
+#endif
+		paeth_scalar(line, prev, length, bpp);
+		break;
+	default:
+		return -1;
+	}
+	return 0;
+}
+
+static PyObject *
+reconstruct(PyObject *self, PyObject *args)
+{
+	Py_buffer data, prev_data = {0};
+	PyObject *prev_line = Py_None;
+	Py_ssize_t width, bpp;
+	Py_ssize_t scanline_bytes, bytes_per_pixel, height, line;
+	int bad_filter = -1;
+	const uint8_t *in, *first_prev;
+	uint8_t *out, *zero_line = NULL;
+	PyObject *result;
+
+	if (!PyArg_ParseTuple(args, "y*nn|O:reconstruct", &data, &width, &bpp, &prev_line))
+		return NULL;
+	if (width < 0 || bpp <= 0) {
+		PyErr_SetString(PyExc_ValueError, "width and bpp must be positive");
+		goto error;
+	}
+
+	scanline_bytes = (width * bpp + 7) / 8;
+	bytes_per_pixel = (bpp + 7) / 8;
+	if (data.len % (scanline_bytes + 1) != 0) {
+		PyErr_SetString(PyExc_ValueError, "data is not made of whole scanlines");
+		goto error;
+	}
+	height = data.len / (scanline_bytes + 1);
+
+	if (prev_line != Py_None) {
+		if (PyObject_GetBuffer(prev_line, &prev_data, PyBUF_SIMPLE) < 0)
+			goto error;
+		if (prev_data.len != scanline_bytes) {
+			PyErr_SetString(PyExc_ValueError, "prev_line must be one scanline");
+			goto error;
+		}
+		first_prev = prev_data.buf;
+	} else {
+		zero_line = calloc(scanline_bytes ? scanline_bytes : 1, 1);
+		if (zero_line == NULL) {
+			PyErr_NoMemory();
+			goto error;
+		}
+		first_prev = zero_line;
+	}
+
+	result = PyBytes_FromStringAndSize(NULL, height * scanline_bytes);
+	if (result == NULL)
+		goto error;
+
+	in = data.buf;
+	out = (uint8_t *)PyBytes_AS_STRING(result);
+	Py_BEGIN_ALLOW_THREADS
+	for (line = 0; line < height; line++) {
+		const uint8_t *filtered = in + line * (scanline_bytes + 1);
+		uint8_t *current = out + line * scanline_bytes;
+		const uint8_t *prev = line ? current - scanline_bytes : first_prev;
+		memcpy(current, filtered + 1, scanline_bytes);
+		if (reconstruct_line(filtered[0], current, prev, scanline_bytes, bytes_per_pixel) < 0) {
+			bad_filter = filtered[0];
+			break;
+		}
+	}
+	Py_END_ALLOW_THREADS
+	if (bad_filter >= 0) {
+		Py_DECREF(result);
+		PyErr_Format(PyExc_ValueError, "Unknown filter type %d", bad_filter);
+		goto error;
+	}
+
+	free(zero_line);
+	if (prev_data.obj != NULL)
+		PyBuffer_Release(&prev_data);
+	PyBuffer_Release(&data);
+	return result;
+
+error:
+	free(zero_line);
+	if (prev_data.obj != NULL)
+		PyBuffer_Release(&prev_data);
+	PyBuffer_Release(&data);
+	return NULL;
+}
+
+static PyMethodDef filter_methods[] = {
+	{"reconstruct", reconstruct, METH_VARARGS,
+	 "reconstruct(data, width, bpp, prev_line=None) -> bytes\n\n"
+	 "Reverse the filters of the decompressed image data."},
+	{NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef filter_module = {
+	PyModuleDef_HEAD_INIT,
+	"png._filter",
+	"C implementation of the PNG filter reconstruction",
+	-1,
+	filter_methods
+};
+
+PyMODINIT_FUNC
+PyInit__filter(void)
+{
+	return PyModule_Create(&filter_module);
+}
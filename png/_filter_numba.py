@@ -0,0 +1,53 @@
+"""Numba compiled scanline reconstruction
+
+All functions take the filtered scanline, the reconstructed previous
+scanline (both contiguous uint8 arrays) and the bytes per pixel and
+reconstruct the scanline in place.
+"""
+import numba
+import numpy as np
+
+jit = numba.njit(cache=True, boundscheck=False)
+
+@jit
+def sub(line, prev, bpp):
+	for i in range(bpp, len(line)):
+		line[i] = (line[i] + line[i-bpp]) & 0xff
+
+@jit
+def up(line, prev, bpp):
+	for i in range(len(line)):
+		line[i] = (line[i] + prev[i]) & 0xff
+
+@jit
+def average(line, prev, bpp):
+	for i in range(bpp):
+		line[i] = (line[i] + prev[i]//2) & 0xff
+	for i in range(bpp, len(line)):
+		line[i] = (line[i] + (line[i-bpp] + prev[i])//2) & 0xff
+
+@jit
+def paeth(line, prev, bpp):
+	for i in range(bpp):
+		line[i] = (line[i] + prev[i]) & 0xff
+	for i in range(bpp, len(line)):
+		a = np.int32(line[i-bpp])
+		b = np.int32(prev[i])
+		c = np.int32(prev[i-bpp])
+		pa = abs(b - c)
+		pb = abs(a - c)
+		pc = abs(a + b - c - c)
+		if pa <= pb and pa <= pc:
+			pred = a
+		elif pb <= pc:
+			pred = b
+		else:
+			pred = c
+		line[i] = (line[i] + pred) & 0xff
+
+filters = {
+	1: sub,
+	2: up,
+	3: average,
+	4: paeth,
+}
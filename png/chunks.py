@@ -1,10 +1,19 @@
 import struct
 import zlib
-import string
+
+try:
+	from ._crc import crc32 # PCLMULQDQ accelerated
+except ImportError:
+	from zlib import crc32
 
 import logging
 L = logging.getLogger("PNG.chunks")
 
+# precompiled formats of the chunk layout
+HEADER = struct.Struct("!I4s") # length, name
+_CRC = struct.Struct("!I")
+_IHDR = struct.Struct("!IIBBBBB")
+
 class Chunk(object):
 	"""Represents any PNG Chunk
 
@@ -28,8 +37,11 @@ class Chunk(object):
 		self.data = data if data else b""
 
 	@classmethod
-	def load(cls, data):
-		"""Load a chunk including header and footer"""
+	def load(cls, data, verify=True):
+		"""Load a chunk including header and footer
+
+		With verify=False the CRC is not checked, call verify_crc() later
+		"""
 		inst = cls()
 		if len(data) < 12:
 			msg = "Chunk-data too small"
@@ -37,15 +49,15 @@ class Chunk(object):
 			raise ValueError(msg)
 
 		# chunk header & data
-		(inst.length, raw_name) = struct.unpack("!I4s", data[0:8])
-		inst.data = data[8:-4]
+		(inst.length, raw_name) = HEADER.unpack_from(data)
+		inst.data = bytes(data[8:-4]) # data may be a memoryview, keep a modifiable copy
 		inst.verify_length()
-		inst.name = raw_name.decode("ascii")
+		inst.name = raw_name
 		inst.verify_name()
 
 		# chunk crc
-		inst.crc = struct.unpack("!I", data[8+inst.length:8+inst.length+4])[0]
-		inst.verify_crc()
+		inst.crc = _CRC.unpack_from(data, 8+inst.length)[0]
+		if verify: inst.verify_crc()
 
 		return inst
 
@@ -54,7 +66,8 @@ class Chunk(object):
 		if auto_length: self.update_length()
 		if auto_crc: self.update_crc()
 		self.verify_name()
-		return struct.pack("!I", self.length) + self.get_raw_name() + self.data + struct.pack("!I", self.crc)
+		header = HEADER.pack(self.length, self.get_raw_name())
+		return b"".join((header, self.data, _CRC.pack(self.crc)))
 
 	def verify_length(self):
 		if len(self.data) != self.length:
@@ -65,13 +78,13 @@ class Chunk(object):
 		return True
 
 	def verify_name(self):
-		for c in self.name:
-			if c not in string.ascii_letters:
-				msg = "Invalid character in chunk name: {}".format(repr(self.name))
-				L.warning(msg)
-				if not self.ignore_errors: raise ValueError(msg)
-				return False
-			return True
+		# bytes.isalpha() only accepts ASCII letters
+		if len(self._raw_name) != 4 or not self._raw_name.isalpha():
+			msg = "Invalid chunk name: {}".format(repr(bytes(self._raw_name)))
+			L.warning(msg)
+			if not self.ignore_errors: raise ValueError(msg)
+			return False
+		return True
 
 	def verify_crc(self):
 		calculated_crc = self.get_crc()
@@ -89,47 +102,50 @@ class Chunk(object):
 		self.crc = self.get_crc()
 
 	def get_crc(self):
-		return zlib.crc32(self.get_raw_name() + self.data)
+		return crc32(self.data, crc32(self._raw_name))
 
 	def get_raw_name(self):
-		return self.name if isinstance(self.name, bytes) else self.name.encode("ascii")
+		return bytes(self._raw_name)
+
+	@property
+	def name(self):
+		return self._raw_name.decode("ascii", "replace")
+
+	@name.setter
+	def name(self, name):
+		# the encoded name is kept since it is needed for every CRC and dump,
+		# it is mutable for the property bit helpers
+		self._raw_name = bytearray(name if isinstance(name, (bytes, bytearray)) else name.encode("ascii"))
 
 	# name helper methods
+	# the property bits are the case bits (0x20) of the name bytes
 
-	def ancillary(self, set=None):
-		"""Set and get ancillary=True/critical=False bit"""
+	def _case_bit(self, index, set=None):
+		"""Set and get lowercase=True/uppercase=False of a name byte"""
 		if set is True:
-			self.name[0] = self.name[0].lower()
+			self._raw_name[index] |= 0x20
 		elif set is False:
-			self.name[0] = self.name[0].upper()
-		return self.name[0].islower()
+			self._raw_name[index] &= ~0x20 & 0xff
+		return bool(self._raw_name[index] & 0x20)
+
+	def ancillary(self, set=None):
+		"""Set and get ancillary=True/critical=False bit"""
+		return self._case_bit(0, set)
 
 	def private(self, set=None):
 		"""Set and get private=True/public=False bit"""
-		if set is True:
-			self.name[1] = self.name[1].lower()
-		elif set is False:
-			self.name[1] = self.name[1].upper()
-		return self.name[1].islower()
+		return self._case_bit(1, set)
 
 	def reserved(self, set=None):
 		"""Set and get reserved_valid=True/invalid=False bit"""
-		if set is True:
-			self.name[2] = self.name[2].upper()
-		elif set is False:
-			self.name[2] = self.name[2].lower()
-		return self.name[2].isupper()
+		return not self._case_bit(2, None if set is None else not set)
 
 	def safe_to_copy(self, set=None):
 		"""Set and get save_to_copy=True/unsafe=False bit"""
-		if set is True:
-			self.name[3] = self.name[3].lower()
-		elif set is False:
-			self.name[3] = self.name[3].upper()
-		return self.name[3].islower()
+		return self._case_bit(3, set)
 
 	def __str__(self):
-		return "<Chunk '{name}' length={length} crc={crc:08X}>".format(**self.__dict__)
+		return "<Chunk '{name}' length={length} crc={crc:08X}>".format(name=self.name, **self.__dict__)
 
 
 class IHDR(Chunk):
@@ -170,9 +186,9 @@ class IHDR(Chunk):
 		super().__init__("IHDR", ignore_errors=ignore_errors)
 
 	@classmethod
-	def load(cls, data):
-		inst = super().load(data)
-		fields = struct.unpack("!IIBBBBB", inst.data)
+	def load(cls, data, verify=True):
+		inst = super().load(data, verify)
+		fields = _IHDR.unpack(inst.data)
 		inst.width = fields[0]
 		inst.height = fields[1]
 		inst.bit_depth = fields[2] # per channel
@@ -183,7 +199,7 @@ class IHDR(Chunk):
 		return inst
 
 	def dump(self):
-		self.data = struct.pack("!IIBBBBB", \
+		self.data = _IHDR.pack( \
 			self.width, self.height, self.bit_depth, self.color_type, \
 			self.compression_method, self.filter_method, self.interlace_method)
 		return super().dump()
@@ -203,17 +219,45 @@ class IDAT(Chunk):
 	http://www.libpng.org/pub/png/spec/1.2/PNG-Chunks.html#C.IDAT
 	"""
 
-	def __init__(self, data=None, uncompressed_data=None, ignore_errors=False):
+	def __init__(self, data=None, uncompressed_data=None, ignore_errors=False, level=9):
 		super().__init__("IDAT", data, ignore_errors=ignore_errors)
+		self.level = level
 		if uncompressed_data:
 			self.compress(uncompressed_data)
 
-	def compress(self, data, level=9):
-		self.data = zlib.compress(data, level)
+	def compress(self, data, level=None):
+		"""Compress data into the chunk, level defaults to the one given on creation"""
+		compressor = zlib.compressobj(self.level if level is None else level, \
+			zlib.DEFLATED, 15, 8, zlib.Z_DEFAULT_STRATEGY)
+		self.data = compressor.compress(data) + compressor.flush()
 
 	def decompress(self):
 		return zlib.decompress(self.data)
 
+	def decompress_into(self, buffer):
+		"""Decompress into a writable buffer, returns the number of bytes written"""
+		out = memoryview(buffer).cast("B")
+		written = 0
+		decompressor = zlib.decompressobj()
+		data = self.data
+		while True:
+			# one byte more than fits tells whether the buffer is too small
+			part = decompressor.decompress(data, len(out) - written + 1)
+			data = decompressor.unconsumed_tail
+			if written + len(part) > len(out):
+				msg = "Buffer of {} bytes is too small for the IDAT data".format(len(out))
+				L.error(msg)
+				raise ValueError(msg)
+			if not part:
+				break
+			out[written:written+len(part)] = part
+			written += len(part)
+		if not decompressor.eof:
+			msg = "IDAT data ends before the end of its zlib stream"
+			L.error(msg)
+			raise ValueError(msg)
+		return written
+
 	def __str__(self):
 		return "<Chunk:IDAT length={length} crc={crc:08X}>".format(**self.__dict__)
 
@@ -1,4 +1,5 @@
-import math, io
+import math
+import zlib
 import logging
 L = logging.getLogger("PNG.filter")
 
@@ -10,66 +11,227 @@ filter_names = {
 	4: "Paeth",
 }
 
-def decode(data, width, bpp):
-	line_start = 0
+# compiled reconstruction, the SIMD C extension is preferred over Cython
+try:
+	from ._filter import reconstruct as _reconstruct
+except ImportError:
+	try:
+		from ._filter_cython import reconstruct as _reconstruct
+	except ImportError:
+		_reconstruct = None
+
+_numba_filters = None
+
+def _load_numba_filters():
+	"""Import the Numba kernels on first use, returns None without Numba"""
+	global _numba_filters
+	if _numba_filters is None:
+		try:
+			from ._filter_numba import filters
+		except ImportError:
+			filters = {}
+		_numba_filters = filters
+	return _numba_filters or None
+
+def decode(data, width, bpp, prev_line=None):
+	"""Reverse the filters of whole scanlines
+
+	prev_line is the reconstructed scanline preceding data when an image
+	is decoded in parts, the first line of an image has none.
+	"""
+	if _reconstruct is not None:
+		return _reconstruct(data, width, bpp, prev_line)
+
+	# imported here so that only decoding without the C extensions and
+	# encoding pay for NumPy, not loading chunks
+	import numpy as np
 	scanline_bytes = math.ceil(width*bpp/8)
 	bytes_per_pixel = math.ceil(bpp/8)
-	outbuf = io.BytesIO()
-	prev_line_data = b"\x00"*scanline_bytes
-	while line_start < len(data):
-		filter_type = data[line_start]
+	if len(data) % (scanline_bytes+1):
+		msg = "Data is not made of whole scanlines"
+		L.error(msg)
+		raise ValueError(msg)
+
+	# one row per scanline with the filter type in the first column
+	filtered = np.frombuffer(data, dtype=np.uint8).reshape(-1, scanline_bytes+1)
+	height = len(filtered)
+	# reconstructed lines, line y of the image is row y+1 so that the
+	# previous line of every row is the one above it
+	lines = np.empty((height+1, scanline_bytes), dtype=np.uint8)
+	lines[0] = 0 if prev_line is None else np.frombuffer(prev_line, dtype=np.uint8)
+	lines[1:] = filtered[:, 1:]
+	# (lines, pixels, bytes per pixel) view, the left neighbours of a pixel
+	# row are the pixel row before it
+	pixels = lines.reshape(height+1, -1, bytes_per_pixel)
+	numba_filters = _load_numba_filters()
+	line = 1
+	while line <= height:
+		filter_type = filtered[line-1, 0]
 		L.debug("Filter for line {} is {} ({})".format(
-			line_start//scanline_bytes,
+			line-1,
 			filter_names.get(filter_type, "unknown"),
 			filter_type)
 		)
+		if filter_type not in filter_names:
+			msg = "Unknown filter type {}".format(filter_type)
+			L.error(msg)
+			raise ValueError(msg)
 
-		outlinebuf = io.BytesIO()
-		line_data = data[line_start+1:line_start+1+scanline_bytes]
-
-		# Filters
-		if filter_type == 0: # None
-			outlinebuf.write(line_data)
+		# Filters, uint8 arithmetic wraps around modulo 256 like the spec requires
+		if numba_filters and filter_type in numba_filters:
+			numba_filters[filter_type](lines[line], lines[line-1], bytes_per_pixel)
+		elif filter_type == 0: # None
+			pass
 		elif filter_type == 1: # Sub
-			for start in range(len(line_data)):
-				if start < bytes_per_pixel:
-					outlinebuf.write(bytes([line_data[start]]))
-				else:
-					outlinebuf.write(bytes([line_start[start] + line_data[start - bytes_per_pixel]]))
+			np.cumsum(pixels[line], axis=0, dtype=np.uint8, out=pixels[line])
 		elif filter_type == 2: # Up
-			for start in range(len(line_data)):
-				outlinebuf.write(bytes([line_data[start] + prev_line_data[start]]))
+			# a run of Up lines is a cumulative sum over those lines
+			end = line+1
+			while end <= height and filtered[end-1, 0] == 2:
+				end += 1
+			np.cumsum(lines[line-1:end], axis=0, dtype=np.uint8, out=lines[line-1:end])
+			line = end
+			continue
 		elif filter_type == 3: # Average
-			for start in range(len(line_data)):
-				if start < bytes_per_pixel:
-					outlinebuf.write(bytes([line_data[start] + prev_line_data[start]]))
-				else:
-					outlinebuf.write(bytes([line_start[start] + (line_data[start - bytes_per_pixel] + prev_line_data[start])//2]))
+			# the left neighbour is the already reconstructed byte, this
+			# recurrence runs faster on Python ints than on tiny arrays
+			current = bytearray(lines[line])
+			prev = bytes(lines[line-1])
+			for i in range(bytes_per_pixel):
+				current[i] = (current[i] + (prev[i] >> 1)) & 0xff
+			for i in range(bytes_per_pixel, scanline_bytes):
+				current[i] = (current[i] + ((current[i-bytes_per_pixel] + prev[i]) >> 1)) & 0xff
+			lines[line] = np.frombuffer(current, dtype=np.uint8)
 		elif filter_type == 4: # Paeth
-			def paeth(a, b, c):
-				p = a+b-c
-				pa = abs(p - a)
-				pb = abs(p - b)
-				pc = abs(p - c)
-				if pa <= pb and pa <= pc: return a
-				if pb <= pc: return b
-				return c
-			for start in range(len(line_data)):
-				if start < bytes_per_pixel:
-					outlinebuf.write(bytes([(line_data[start] + paeth(0, prev_line_data[start], 0))&0xff]))
-				else:
-					outlinebuf.write(bytes([(line_data[start] + paeth(line_data[start - bytes_per_pixel], prev_line_data[start], prev_line_data[start - bytes_per_pixel]))&0xff]))
-		outlinebuf.seek(0)
-		prev_line_data = outlinebuf.read()
-		outbuf.write(prev_line_data)
-		line_start += scanline_bytes+1
-	outbuf.seek(0)
-	return outbuf.read()
-
-def encode(data, scanline_bytes, force_filter=None):
-	out = b""
-	lines = 0
-	while len(out) - lines < len(data):
-		out += b"\x00" + data[lines*scanline_bytes:lines*scanline_bytes + scanline_bytes]
-		lines += 1
-	return out
+			if not lines[line-1].any():
+				# paeth(a, 0, 0) is always a, which makes this a Sub filter
+				np.cumsum(pixels[line], axis=0, dtype=np.uint8, out=pixels[line])
+			else:
+				current = bytearray(lines[line])
+				prev = bytes(lines[line-1])
+				for i in range(bytes_per_pixel):
+					current[i] = (current[i] + prev[i]) & 0xff # paeth(0, b, 0) is always b
+				for i in range(bytes_per_pixel, scanline_bytes):
+					a = current[i-bytes_per_pixel]
+					b = prev[i]
+					c = prev[i-bytes_per_pixel]
+					# with p = a+b-c: pa = |b-c|, pb = |a-c| and pc = |(b-c) + (a-c)|
+					up_diff = b - c
+					left_diff = a - c
+					pa = abs(up_diff)
+					pb = abs(left_diff)
+					pc = abs(up_diff + left_diff)
+					if pa <= pb and pa <= pc:
+						current[i] = (current[i] + a) & 0xff
+					elif pb <= pc:
+						current[i] = (current[i] + b) & 0xff
+					else:
+						current[i] = (current[i] + c) & 0xff
+				lines[line] = np.frombuffer(current, dtype=np.uint8)
+		line += 1
+	return lines[1:].tobytes()
+
+def decode_stream(compressed_parts, width, height, bpp):
+	"""Decompress and decode image data in one pass
+
+	compressed_parts is an iterable of zlib data, usually the data of all
+	IDAT chunks. Scanlines are decoded in small batches as they are
+	decompressed, so the whole filtered stream is never held in memory.
+	"""
+	scanline_bytes = math.ceil(width*bpp/8)
+	filtered_bytes = scanline_bytes+1
+	# enough lines for about 64KiB, which stays in the CPU cache
+	batch_bytes = max(1, 2**16 // filtered_bytes) * filtered_bytes
+	outbuf = bytearray(height*scanline_bytes)
+	out = memoryview(outbuf)
+	line = 0
+	prev_line = None
+	decompressor = zlib.decompressobj()
+	pending = bytearray()
+	extra = 0
+	for compressed in compressed_parts:
+		while True:
+			if line == height:
+				# only counted, so that max_length below never drops to 0
+				extra += len(pending)
+				pending.clear()
+			data = decompressor.decompress(compressed, batch_bytes - len(pending))
+			compressed = decompressor.unconsumed_tail
+			if not data and not compressed:
+				break
+			pending += data
+			lines = min(len(pending) // filtered_bytes, height - line)
+			if not lines:
+				continue
+			with memoryview(pending)[:lines*filtered_bytes] as filtered:
+				out[line*scanline_bytes:(line+lines)*scanline_bytes] = decode(filtered, width, bpp, prev_line)
+			del pending[:lines*filtered_bytes]
+			line += lines
+			# the previous line is read from the output, not copied
+			prev_line = out[(line-1)*scanline_bytes:line*scanline_bytes]
+
+	if line < height:
+		msg = "Image data ends after {} of {} scanlines".format(line, height)
+		L.error(msg)
+		raise ValueError(msg)
+	if not decompressor.eof:
+		msg = "Image data ends before the end of its zlib stream"
+		L.error(msg)
+		raise ValueError(msg)
+	extra += len(pending)
+	if extra:
+		L.warning("Ignoring {} bytes of image data after {} scanlines".format(extra, height))
+	if decompressor.unused_data:
+		L.warning("Ignoring {} bytes after the zlib stream".format(len(decompressor.unused_data)))
+	return bytes(outbuf)
+
+def encode(data, scanline_bytes, force_filter=None, bytes_per_pixel=1):
+	"""Filter raw image data
+
+	All lines use force_filter, or the None filter if it isn't given.
+	bytes_per_pixel is the distance to the left neighbour used by the
+	Sub, Average and Paeth filters, at least one byte like in decode.
+	"""
+	import numpy as np
+
+	filter_type = force_filter or 0
+	if filter_type not in filter_names:
+		msg = "Unknown filter type {}".format(filter_type)
+		L.error(msg)
+		raise ValueError(msg)
+
+	if len(data) % scanline_bytes:
+		msg = "Data is not made of whole scanlines"
+		L.error(msg)
+		raise ValueError(msg)
+	height = len(data)//scanline_bytes
+	out = np.empty((height, scanline_bytes+1), dtype=np.uint8)
+	out[:, 0] = filter_type
+	lines = np.frombuffer(data, dtype=np.uint8, count=height*scanline_bytes).reshape(height, scanline_bytes)
+	if filter_type == 0: # None
+		out[:, 1:] = lines
+		return out.tobytes()
+
+	# unlike decoding all neighbours are raw bytes, so the whole image is
+	# filtered at once
+	lines = lines.astype(np.int16)
+	a = np.zeros_like(lines) # left
+	a[:, bytes_per_pixel:] = lines[:, :-bytes_per_pixel]
+	b = np.zeros_like(lines) # up
+	b[1:] = lines[:-1]
+	c = np.zeros_like(lines) # up left
+	c[1:, bytes_per_pixel:] = lines[:-1, :-bytes_per_pixel]
+	if filter_type == 1: # Sub
+		predicted = a
+	elif filter_type == 2: # Up
+		predicted = b
+	elif filter_type == 3: # Average
+		predicted = (a + b) // 2
+	elif filter_type == 4: # Paeth
+		p = a+b-c
+		pa = np.abs(p - a)
+		pb = np.abs(p - b)
+		pc = np.abs(p - c)
+		predicted = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+	out[:, 1:] = (lines - predicted) & 0xff
+	return out.tobytes()
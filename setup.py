@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+import platform
+from setuptools import setup, Extension
+
+try:
+	from Cython.Build import cythonize
+except ImportError:
+	cythonize = None
+
+extra_compile_args = ["-O3"]
+if platform.machine().lower() in ("x86_64", "amd64", "i386", "i686"):
+	extra_compile_args.append("-msse2")
+
+ext_modules = [
+	# optional, png falls back to Python/zlib if these can't be built
+	Extension("png._filter", ["png/_filter.c"], extra_compile_args=extra_compile_args, optional=True),
+	# picks PCLMULQDQ at runtime, no extra -m flags needed
+	Extension("png._crc", ["png/_crc.c"], extra_compile_args=["-O3"], optional=True),
+]
+if cythonize is not None:
+	ext_modules += cythonize(
+		[Extension("png._filter_cython", ["png/_filter_cython.pyx"], extra_compile_args=["-O3"], optional=True)],
+		compiler_directives={"language_level": "3str"},
+	)
+
+setup(
+	name="png",
+	description="Load PNG chunks and manipulate them",
+	packages=["png"],
+	install_requires=["numpy"],
+	ext_modules=ext_modules,
+)
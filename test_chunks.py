@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import random
+import unittest
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from png import PNG, PARALLEL_CRC_MIN_LENGTH, chunks, filter
+
+try:
+	from png import _crc
+except ImportError:
+	_crc = None
+
+
+@unittest.skipIf(_crc is None, "png._crc is not built")
+class CRCTest(unittest.TestCase):
+	# around the 64 byte minimum of the PCLMULQDQ folding and its 16 byte steps
+	LENGTHS = sorted({0, 1, 15, 16, 17, 4096, 65537} |
+		{n + d for n in (64, 80, 128, 144, 192) for d in (-1, 0, 1)})
+
+	def test_matches_zlib(self):
+		rand = random.Random(2)
+		for length in self.LENGTHS:
+			data = rand.randbytes(length)
+			with self.subTest(length=length):
+				self.assertEqual(_crc.crc32(data), zlib.crc32(data))
+				self.assertEqual(_crc.crc32(data, 0xdeadbeef), zlib.crc32(data, 0xdeadbeef))
+
+	def test_chained(self):
+		data = random.Random(3).randbytes(300)
+		self.assertEqual(_crc.crc32(data[100:], _crc.crc32(data[:100])), zlib.crc32(data))
+
+
+class PropertyBitTest(unittest.TestCase):
+	# (method, name byte, value of the bit in "IDAT")
+	BITS = [("ancillary", 0, False), ("private", 1, False), ("reserved", 2, True), ("safe_to_copy", 3, False)]
+
+	def test_get(self):
+		chunk = chunks.Chunk("IDAT")
+		for method, index, value in self.BITS:
+			with self.subTest(method):
+				self.assertIs(getattr(chunk, method)(), value)
+		chunk = chunks.Chunk("tEXt")
+		self.assertEqual([chunk.ancillary(), chunk.private(), chunk.reserved(), chunk.safe_to_copy()],
+			[True, False, True, True])
+
+	def test_set(self):
+		for method, index, value in self.BITS:
+			for new in (not value, value):
+				with self.subTest(method=method, set=new):
+					chunk = chunks.Chunk("IDAT", b"data")
+					self.assertIs(getattr(chunk, method)(new), new)
+					self.assertIs(getattr(chunk, method)(), new)
+					name = bytearray(b"IDAT")
+					if new != value:
+						name[index] ^= 0x20
+					self.assertEqual(chunk.get_raw_name(), name)
+					self.assertEqual(chunk.name, name.decode("ascii"))
+					self.assertEqual(chunk.get_crc(), zlib.crc32(name + b"data"))
+					# the other bits are left alone
+					for other, other_index, other_value in self.BITS:
+						if other != method:
+							self.assertIs(getattr(chunk, other)(), other_value)
+
+	def test_set_dump(self):
+		chunk = chunks.Chunk("tEXt", b"abc")
+		chunk.ancillary(False)
+		chunk.safe_to_copy(False)
+		loaded = chunks.Chunk.load(chunk.dump())
+		self.assertEqual(loaded.name, "TEXT")
+		self.assertEqual(loaded.crc, zlib.crc32(b"TEXTabc"))
+
+
+class IDATTest(unittest.TestCase):
+	RAW = random.Random(5).randbytes(1000)
+
+	def test_decompress_into(self):
+		buffer = bytearray(len(self.RAW) + 10)
+		self.assertEqual(chunks.IDAT(uncompressed_data=self.RAW).decompress_into(buffer), len(self.RAW))
+		self.assertEqual(buffer[:len(self.RAW)], self.RAW)
+		buffer = bytearray(len(self.RAW))
+		self.assertEqual(chunks.IDAT(uncompressed_data=self.RAW).decompress_into(buffer), len(self.RAW))
+		self.assertEqual(buffer, self.RAW)
+
+	def test_decompress_into_small_buffer(self):
+		with self.assertRaises(ValueError):
+			chunks.IDAT(uncompressed_data=self.RAW).decompress_into(bytearray(len(self.RAW) - 1))
+
+	def test_decompress_into_truncated(self):
+		idat = chunks.IDAT(uncompressed_data=self.RAW)
+		# without the Adler-32 checksum, and cut in the deflate data
+		for data in (idat.data[:-4], idat.data[:len(idat.data)//2]):
+			with self.subTest(length=len(data)):
+				with self.assertRaises(ValueError):
+					chunks.IDAT(data).decompress_into(bytearray(len(self.RAW)))
+
+
+class PNGRoundTripTest(unittest.TestCase):
+	def test_dump_load(self):
+		width, height = 7, 5
+		raw = random.Random(4).randbytes(width*height*4)
+		for ft in range(5):
+			with self.subTest(filter=ft):
+				png = PNG()
+				png.chunks.append(chunks.IHDR(width=width, height=height, color_type=chunks.IHDR.COLOR_TYPE_RGBA))
+				png.chunks.append(chunks.IDAT(uncompressed_data=filter.encode(raw, width*4, ft, 4)))
+				png.chunks.append(chunks.IEND())
+				data = png.dump()
+
+				loaded = PNG.load(data)
+				self.assertEqual(loaded.dump(), data)
+				idat = loaded.chunks[1]
+				self.assertEqual(filter.decode(idat.decompress(), width, 32), raw)
+
+	def test_crc_mismatch(self):
+		chunk = chunks.Chunk("tEXt", b"abc")
+		data = bytearray(chunk.dump())
+		data[-1] ^= 1
+		with self.assertRaises(ValueError):
+			chunks.Chunk.load(bytes(data))
+
+	def corrupted_png(self, length):
+		"""PNG data with a broken CRC on an IDAT chunk of about length bytes"""
+		png = PNG()
+		png.chunks.append(chunks.IHDR(width=1, height=1, color_type=chunks.IHDR.COLOR_TYPE_RGBA))
+		idat = chunks.IDAT()
+		idat.data = random.Random(7).randbytes(length)
+		png.chunks.append(idat)
+		png.chunks.append(chunks.IEND())
+		data = bytearray(png.dump())
+		data[-12-1] ^= 1 # last byte of the IDAT CRC
+		return bytes(data)
+
+	def test_crc_mismatch_executor(self):
+		for length in (100, PARALLEL_CRC_MIN_LENGTH + 1000):
+			with self.subTest(length=length), ThreadPoolExecutor(2) as executor:
+				with self.assertRaises(ValueError):
+					PNG.load(self.corrupted_png(length), executor=executor)
+
+	def test_no_verify(self):
+		data = self.corrupted_png(100)
+		with self.assertRaises(ValueError):
+			PNG.load(data)
+		png = PNG.load(data, verify=False)
+		self.assertEqual([chunk.name for chunk in png.chunks], ["IHDR", "IDAT", "IEND"])
+		with self.assertRaises(ValueError):
+			png.chunks[1].verify_crc()
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+import importlib
+import math
+import random
+import unittest
+import zlib
+from unittest import mock
+
+from png import filter
+
+# (width, bits per pixel) covering sub-byte, 8 and 16 bit channels
+GEOMETRIES = [(13, 1), (7, 4), (9, 8), (11, 16), (10, 24), (6, 32), (5, 48), (4, 64)]
+HEIGHT = 9
+
+def backends():
+	"""(name, compiled reconstruct, Numba filters) of the importable backends"""
+	found = []
+	for module in ("png._filter", "png._filter_cython"):
+		try:
+			found.append((module, importlib.import_module(module).reconstruct, {}))
+		except ImportError:
+			pass
+	try:
+		from png._filter_numba import filters
+		found.append(("numba", None, filters))
+	except ImportError:
+		pass
+	found.append(("numpy", None, {}))
+	return found
+
+def mixed_filters(raw, scanline_bytes, bytes_per_pixel):
+	"""Filtered data using filter type y % 5 for line y"""
+	encoded = [filter.encode(raw, scanline_bytes, ft, bytes_per_pixel) for ft in range(5)]
+	lines = len(raw) // scanline_bytes
+	step = scanline_bytes+1
+	return b"".join(encoded[y % 5][y*step:(y+1)*step] for y in range(lines))
+
+
+class FilterRoundTripTest(unittest.TestCase):
+	def cases(self):
+		rand = random.Random(1)
+		for width, bpp in GEOMETRIES:
+			scanline_bytes = math.ceil(width*bpp/8)
+			bytes_per_pixel = math.ceil(bpp/8)
+			raw = rand.randbytes(scanline_bytes*HEIGHT)
+			for ft in range(5):
+				yield (width, bpp, ft), raw, filter.encode(raw, scanline_bytes, ft, bytes_per_pixel)
+			yield (width, bpp, "mixed"), raw, mixed_filters(raw, scanline_bytes, bytes_per_pixel)
+
+	def test_decode(self):
+		for name, reconstruct, numba_filters in backends():
+			with mock.patch.object(filter, "_reconstruct", reconstruct), \
+			     mock.patch.object(filter, "_numba_filters", numba_filters):
+				for (width, bpp, ft), raw, filtered in self.cases():
+					with self.subTest(backend=name, width=width, bpp=bpp, filter=ft):
+						self.assertEqual(filter.decode(filtered, width, bpp), raw)
+
+	def test_decode_in_parts(self):
+		for name, reconstruct, numba_filters in backends():
+			with mock.patch.object(filter, "_reconstruct", reconstruct), \
+			     mock.patch.object(filter, "_numba_filters", numba_filters):
+				for (width, bpp, ft), raw, filtered in self.cases():
+					with self.subTest(backend=name, width=width, bpp=bpp, filter=ft):
+						split = (HEIGHT//2) * (len(filtered)//HEIGHT)
+						first = filter.decode(filtered[:split], width, bpp)
+						scanline_bytes = math.ceil(width*bpp/8)
+						second = filter.decode(filtered[split:], width, bpp, first[-scanline_bytes:])
+						self.assertEqual(first + second, raw)
+
+	def test_decode_stream(self):
+		for name, reconstruct, numba_filters in backends():
+			with mock.patch.object(filter, "_reconstruct", reconstruct), \
+			     mock.patch.object(filter, "_numba_filters", numba_filters):
+				for (width, bpp, ft), raw, filtered in self.cases():
+					with self.subTest(backend=name, width=width, bpp=bpp, filter=ft):
+						compressed = zlib.compress(filtered)
+						parts = [compressed[i:i+7] for i in range(0, len(compressed), 7)]
+						self.assertEqual(filter.decode_stream(parts, width, HEIGHT, bpp), raw)
+
+	def test_truncated_stream(self):
+		compressed = zlib.compress(filter.encode(bytes(30*HEIGHT), 30))
+		with self.assertRaises(ValueError):
+			filter.decode_stream([compressed], 10, HEIGHT+1, 24)
+
+	def test_unknown_filter(self):
+		for name, reconstruct, numba_filters in backends():
+			with mock.patch.object(filter, "_reconstruct", reconstruct), \
+			     mock.patch.object(filter, "_numba_filters", numba_filters):
+				for filtered in (bytes([5, 1, 2, 3]), bytes([0, 1, 2, 3, 255, 4, 5, 6])):
+					with self.subTest(backend=name, filtered=filtered):
+						with self.assertRaisesRegex(ValueError, "Unknown filter type"):
+							filter.decode(filtered, 3, 8)
+
+	def test_stream_without_checksum(self):
+		compressed = zlib.compress(filter.encode(bytes(30*HEIGHT), 30))
+		with self.assertRaises(ValueError):
+			filter.decode_stream([compressed[:-4]], 10, HEIGHT, 24)
+
+	def test_stream_trailing_data(self):
+		raw = random.Random(6).randbytes(30*HEIGHT)
+		filtered = filter.encode(raw, 30)
+		for name, parts, height in (
+				("garbage", [zlib.compress(filtered), b"garbage"], HEIGHT),
+				("garbage in part", [zlib.compress(filtered) + b"garbage"], HEIGHT),
+				("extra scanline", [zlib.compress(filtered)], HEIGHT-1)):
+			with self.subTest(name):
+				with self.assertLogs("PNG.filter", "WARNING"):
+					self.assertEqual(filter.decode_stream(parts, 10, height, 24), raw[:30*height])
+
+	def test_partial_scanline(self):
+		with self.assertRaises(ValueError):
+			filter.encode(bytes(31), 10)
+		with self.assertRaises(ValueError):
+			filter.decode(bytes(12), 10, 8)
+
+
+if __name__ == "__main__":
+	unittest.main()